@@ -4,19 +4,101 @@
 """
 from typing import Dict
 
-import itertools
-import json
+import functools
+import logging
 import os
 import re
+import sys
 import time
 import traceback
-from datetime import datetime
-from enum import Enum
+from enum import Enum, IntEnum
 
 import boto3
 
+# json is imported lazily in the stdlib fallback of _write_json_to_file. re and traceback stay top level, logging imports
+# them anyway.
 
-class StatusCode(Enum):
+try:
+    # optional, serializes the (often MB sized) module results much faster than the stdlib
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+
+class _StdoutHandler(logging.StreamHandler):
+    """
+    Writes the log records to stdout next to the tagged prints parsed by the master. Unlike logging.StreamHandler it does not
+    flush after every record, the records stay in the stdout buffer until it fills up or main() flushes it.
+    """
+
+    def emit(self, record):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+def _configure_logging():
+    """Sends the INFO logs of the modules to stdout, unless the application configured logging itself"""
+    root_logger = logging.getLogger()
+    if not root_logger.handlers:
+        handler = _StdoutHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        root_logger.addHandler(handler)
+        root_logger.setLevel(logging.INFO)
+
+
+# frames kept in the traces of error responses, passed negated to traceback so the deepest ones are kept
+_TRACEBACK_LIMIT = 20
+
+
+@functools.lru_cache(maxsize=None)
+def _get_aws_secret_re():
+    """Regex scrubbing AWS secret keys from the traces sent back in error responses, compiled on the first error"""
+    return re.compile(r"(?:AWS|aws_secret_access_key).*?(?:[A-Za-z0-9/+]{40})")
+
+
+@functools.lru_cache(maxsize=8)
+def _get_sts_client(access_key_id, secret_access_key):
+    """STS client per credential pair, building a boto3 client loads the botocore service models every time"""
+    return boto3.client("sts", aws_access_key_id=access_key_id, aws_secret_access_key=secret_access_key)
+
+
+def _compile_substring_alternation(substrings):
+    """
+    Compiles a regex matching any of the literal substrings, so a text is searched for all of them in one pass. The longer
+    substrings come first, so of the ones found at the same position the most specific is matched.
+    """
+    ordered = sorted(dict.fromkeys(substrings), key=len, reverse=True)
+    return re.compile("|".join(map(re.escape, ordered)) or "(?!)")
+
+
+def _encode_json_member(key, value):
+    """
+    Encodes the `"key":value` member of a JSON object as bytes, for writers streaming a large object one member at a time.
+    Keys and values are encoded the same as within a whole object, datetimes and other unknown types with str.
+    """
+    if orjson is not None:
+        # a one member dict keeps the key handling of OPT_NON_STR_KEYS, returned without its braces
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        return memoryview(orjson.dumps({key: value}, default=str, option=option))[1:-1]
+    import json
+
+    return json.dumps({key: value}, default=str)[1:-1].encode()
+
+
+def _encode_json(data):
+    """Encodes data as JSON bytes, its values the same as by _encode_json_member."""
+    if orjson is not None:
+        return orjson.dumps(data, default=str, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+    import json
+
+    return json.dumps(data, default=str).encode()
+
+
+class StatusCode(IntEnum):
     EMPTY_ATTRIBUTE = 1001
     INSTALL_DEPENDENCY = 1003
     CLONE_ERROR = 1004
@@ -58,6 +140,14 @@ class ModuleException(Exception):
     Custom module exception that is used in every module
     """
 
+    __slots__ = (
+        "status_code",
+        "additional_info",
+        "subprocess_return_code",
+        "subprocess_standard_output",
+        "subprocess_standard_error",
+    )
+
     def __init__(
         self,
         msg,
@@ -94,6 +184,29 @@ class BaseModule:
         "UnknownError",
     ]
 
+    # structure of every error response, copied and filled in by _generate_error_response
+    _ERROR_RESPONSE_TEMPLATE = {
+        "response": None,
+        "status_code": None,
+        "trace": None,
+        "additional_info": None,
+        "subprocess_return_code": None,
+        "subprocess_standard_output": None,
+        "subprocess_standard_error": "<error>subprocess_standard_error</error>",
+    }
+
+    @classmethod
+    def _get_access_exception_re(cls):
+        """
+        Returns the one pass search for all the identifiers of _access_exception_list. It is compiled on first use for every
+        class, so subclasses overriding the list get their own.
+        """
+        pattern = cls.__dict__.get("_access_exception_re")
+        if pattern is None:
+            pattern = _compile_substring_alternation(cls._access_exception_list)
+            cls._access_exception_re = pattern
+        return pattern
+
     def __init__(
         self,
         kwargs: Dict,
@@ -107,8 +220,10 @@ class BaseModule:
             setattr(self, key, value)
 
     def main(self) -> Dict:
-        current_time = time.time()
-        print(f"Starting the main function at {current_time}")
+        # monotonic clock for the duration, it is not affected by wall clock adjustments
+        start_time = time.monotonic()
+        _configure_logging()
+        logger.info("Starting the main function at %s", time.time())
 
         try:
             self._check_fields()  # Verifies that required fields for running the module are filled and raises an error if a field is empty
@@ -125,44 +240,53 @@ class BaseModule:
                 e.subprocess_return_code,
                 e.subprocess_standard_output,
                 e.subprocess_standard_error,
+                trace=self._format_traceback(e),
             )
 
-        except ModuleNotFoundError:
+        except ModuleNotFoundError as ex:
             return self._generate_error_response(
                 "Couldn't properly initialize or import a package",
                 StatusCode.PACKAGE_NOT_FOUND,
+                trace=self._format_traceback(ex),
             )
 
         except Exception as ex:
+            trace = self._format_traceback(ex)
             return self._generate_error_response(
-                f"Unexpected error {ex} {traceback.format_exc()}",
+                f"Unexpected error {ex} {trace}",
                 StatusCode.UNEXPECTED_ERROR,
+                trace=trace,
             )
 
         finally:
-            print(f"It took {time.time() - current_time} seconds to execute the playbook {self.__class__.__name__}")
+            logger.info(
+                "It took %s seconds to execute the playbook %s", time.monotonic() - start_time, self.__class__.__name__
+            )
+            sys.stdout.flush()
 
     def _check_fields(self):
         """
         Checking all required fields
         """
-        print("Checking all required fields were passed")
-        for field in self._fields:
-            if not getattr(self, field):
-                raise ModuleException(
-                    f"Provide {field} value",
-                    StatusCode.EMPTY_ATTRIBUTE,
-                )
+        logger.info("Checking all required fields were passed")
+        # the fields are instance attributes set from the kwargs, so the instance dict is checked directly and all the
+        # missing fields are reported at once
+        instance_fields = self.__dict__
+        missing_fields = [field for field in self._fields if not instance_fields.get(field)]
+        if missing_fields:
+            raise ModuleException(
+                f"Provide {', '.join(missing_fields)} value",
+                StatusCode.EMPTY_ATTRIBUTE,
+            )
 
-        print("All fields were checked")
+        logger.info("All fields were checked")
 
     def construct_filename(self, parser_prefix, file_extension, keep_integral=True):
         if keep_integral:
-            time_suffix = str(time.time()).split(".")[0]
+            time_suffix = str(int(time.time()))
         else:
-            time_suffix = str(time.time())
-        filename = os.path.join("/tmp", f"{self.label}-{parser_prefix}-{time_suffix}.{file_extension}")
-        return filename
+            time_suffix = f"{time.time():.6f}"
+        return f"/tmp/{self.label}-{parser_prefix}-{time_suffix}.{file_extension}"
 
     def _write_to_file(
         self,
@@ -179,11 +303,15 @@ class BaseModule:
         data: The data to write to the file
         decode: a boolean parameter that determines whether or not to decode data into UTF-8 format. This is used if the data comes from subprocess
         output where it is in bytes format.
-        jsonify: a boolean parameter that determines whether or not the data should be converted to JSON with the json.dumps method.
+        jsonify: a boolean parameter that determines whether or not the data should be converted to JSON. The JSON is streamed into the file
+        instead of being built as one string first.
         binary: Writes to file in binary mode instead of regular mode.
 
         Note that if both decode and jsonify are true it will always perform the decode operation first because it can't convert a bytes data type to JSON.
         """
+        if binary and not decode and not jsonify and isinstance(data, (bytes, bytearray, memoryview)):
+            self._write_bytes_to_file(filename, data)
+            return
         if binary:
             write_mode = "wb"
         else:
@@ -197,21 +325,78 @@ class BaseModule:
                     StatusCode.SUBPROCESS_OUTPUT_DECODE_ERROR,
                 )
         if jsonify:
+            self._write_json_to_file(filename, data)
+            return
+        with open(filename, write_mode) as f:
             try:
-                data = json.dumps(data, default=str)
+                f.write(data)
             except Exception:
                 raise ModuleException(
-                    "<error>Results data could not be JSON encoded.</error>",
-                    StatusCode.JSON_ENCODE_ERROR,
+                    "<error>Could not write results data to file.</error>",
+                    StatusCode.FILE_ERROR,
                 )
-        with open(filename, write_mode) as f:
+
+    @staticmethod
+    def _write_bytes_to_file(filename, data):
+        """
+        Writes bytes with os.write on a raw file descriptor, bytes written in one go gain nothing from the buffering and
+        context management of a file object
+        """
+        try:
+            fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
             try:
-                f.write(data)
-            except Exception:
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view) :]
+            finally:
+                os.close(fd)
+        except OSError:
+            raise ModuleException(
+                "<error>Could not write results data to file.</error>",
+                StatusCode.FILE_ERROR,
+            )
+
+    @staticmethod
+    def _write_json_to_file(filename, data):
+        """
+        Serializes data as JSON straight into the file. With orjson a top level list or dict is written item by item, with the
+        stdlib json.dump writes the chunks as they are encoded, so the whole document is never held in memory as one string.
+        """
+        with open(filename, "wb" if orjson is not None else "w") as f:
+            try:
+                if orjson is not None:
+                    # Datetimes are passed through to default=str so they are formatted the same as with the stdlib
+                    option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+                    if isinstance(data, list):
+                        f.write(b"[")
+                        for index, item in enumerate(data):
+                            if index:
+                                f.write(b",")
+                            f.write(orjson.dumps(item, default=str, option=option))
+                        f.write(b"]")
+                    elif isinstance(data, dict):
+                        f.write(b"{")
+                        for index, (key, value) in enumerate(data.items()):
+                            if index:
+                                f.write(b",")
+                            f.write(_encode_json_member(key, value))
+                        f.write(b"}")
+                    else:
+                        f.write(orjson.dumps(data, default=str, option=option))
+                else:
+                    import json
+
+                    json.dump(data, f, default=str)
+            except OSError:
                 raise ModuleException(
                     "<error>Could not write results data to file.</error>",
                     StatusCode.FILE_ERROR,
                 )
+            except Exception:
+                raise ModuleException(
+                    "<error>Results data could not be JSON encoded.</error>",
+                    StatusCode.JSON_ENCODE_ERROR,
+                )
 
     def run(self) -> Dict:
         """
@@ -228,6 +413,7 @@ class BaseModule:
         subprocess_return_code: int = None,
         subprocess_standard_output=None,
         subprocess_standard_error=None,
+        trace: str = None,
     ) -> Dict:
         """
         Generates a custom response dictionary for errors
@@ -236,65 +422,81 @@ class BaseModule:
         :additional_info: additional info that you want to send to divy backend
         :subprocess_return_code If a subprocess call fails, this should be sent to the method. Otherwise, it is not used.
         :stdout and stderr If a subprocess call fails, this should be sent to the method. Otherwise, it is not used.
+        :trace The already formatted traceback of the handled exception. Otherwise the current one is formatted.
         """
 
-        trace = traceback.format_exc()
-        pattern = r"(?:AWS|aws_secret_access_key).*?(?:[A-Za-z0-9/+]{40})"
-        trace = re.sub(pattern, "", trace)
-        print(msg)
-
-        return {
-            "response": f"<error>[{self._module_name}]: {msg}</error>",
-            "status_code": status_code.value,
-            "trace": trace,
-            "additional_info": additional_info,
-            "subprocess_return_code": subprocess_return_code,
-            "subprocess_standard_output": subprocess_standard_output,
-            "subprocess_standard_error": "<error>subprocess_standard_error</error>",
-        }
+        if trace is None:
+            trace = traceback.format_exc(limit=-_TRACEBACK_LIMIT)
+        trace = _get_aws_secret_re().sub("", trace)
+        logger.error(msg)
+
+        response = self._ERROR_RESPONSE_TEMPLATE.copy()
+        response["response"] = f"<error>[{self._module_name}]: {msg}</error>"
+        response["status_code"] = int(status_code)
+        response["trace"] = trace
+        response["additional_info"] = additional_info
+        response["subprocess_return_code"] = subprocess_return_code
+        response["subprocess_standard_output"] = subprocess_standard_output
+        return response
+
+    @staticmethod
+    def _format_traceback(exception: BaseException) -> str:
+        """Formats the traceback of the exception, limited to the deepest _TRACEBACK_LIMIT frames"""
+        return "".join(traceback.TracebackException.from_exception(exception, limit=-_TRACEBACK_LIMIT).format())
 
     def setup_aws_env_vars(self):
         """A helper method to setup commonly used AWS Env vars"""
-        print("Setting up AWS Env vars")
-        self.setup_aws_access_key_and_secret_key()
+        logger.info("Setting up AWS Env vars")
+        aws_env_vars = self._get_aws_access_key_env_vars()
 
         if self.source_key_token:
-            os.environ["AWS_SESSION_TOKEN"] = self.source_key_token
+            aws_env_vars["AWS_SESSION_TOKEN"] = self.source_key_token
+        os.environ.update(aws_env_vars)
 
     def setup_aws_access_key_and_secret_key(self):
         """A helper method to setup AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY env vars"""
-        print("Setting up AWS Access key id and secret key vars")
-        os.environ["AWS_ACCESS_KEY_ID"] = self.source_key_id
-        os.environ["AWS_SECRET_ACCESS_KEY"] = self.source_key
+        os.environ.update(self._get_aws_access_key_env_vars())
+
+    def _get_aws_access_key_env_vars(self) -> Dict:
+        logger.info("Setting up AWS Access key id and secret key vars")
+        return {"AWS_ACCESS_KEY_ID": self.source_key_id, "AWS_SECRET_ACCESS_KEY": self.source_key}
 
-    def _get_data(self, client, method: str, key: str) -> Dict:
+    def _get_data(self, client, method: str, key: str, page_size: int = None) -> Dict:
         """
         client: The boto3 client object.
         Method: The name of the method on the client object, such as "describe buckets"
         key: The JSON key where the data is stored.
+        page_size: Optional page size for paginated operations, fewer round trips for operations that support it.
 
         get_data: The boto3 method stored in a variable
         Page data: a single page of data
         Data: The entire dataset.
         """
+        if client.can_paginate(method):
+            # The boto3 paginator knows the token field of every operation (NextToken, Marker, ContinuationToken, ...)
+            pagination_config = {"PageSize": page_size} if page_size else {}
+            pages = client.get_paginator(method).paginate(PaginationConfig=pagination_config)
+            return {key: [item for page in pages for item in page[key]]}
+
         get_data = getattr(client, method)
         page_data = get_data()
-        data = {}
-        data[key] = []
-        data[key].append(page_data[key])
+        # The items of every page are appended to a single list, so no nested per page structure has to be flattened.
+        data = {key: list(page_data[key])}
         while "nextToken" in page_data:
             page_data = get_data(nextToken=page_data["nextToken"])
-            data[key].append(page_data[key])
+            data[key].extend(page_data[key])
 
-        # This is now in nested list structure if there was more than one page. Flatten into a single list.
-        data[key] = list(itertools.chain(*data[key]))
         return data
 
-    def _create_folder(self, path: str):
+    def _create_folder(self, path: str) -> str:
+        """
+        Creates the folder and returns its path. The working directory is left as it is, it is shared by every thread of the
+        process, so callers build the paths inside the folder with os.path.join(path, name).
+        """
         os.makedirs(path, exist_ok=True)
-        os.chdir(path)
 
-        print(f"Created directory {path}")
+        logger.info("Created directory %s", path)
+        return path
 
     def has_authentication_error(self, exception):
         if isinstance(exception, ModuleException):
@@ -305,22 +507,21 @@ class BaseModule:
         if isinstance(error_string, bytes):
             error_string = error_string.decode("utf-8", "ignore")
 
-        for exception_identifier in self._access_exception_list:
-            if exception_identifier in error_string:
-                return exception_identifier
+        match = self._get_access_exception_re().search(error_string)
+        if match:
+            return match.group()
         return False
 
     def assume_role_if_role_arn_provided(self):
         # todo: if assume role with 12 hour duration failes, then assume role again, get the max duration of role
         # then assume role again based on max duration
         if hasattr(self, "role_arn") and self.role_arn:
-            print(f"assuming role")
-            sts_client = boto3.client(
-                "sts", **{"aws_access_key_id": self.source_key_id, "aws_secret_access_key": self.source_key}
-            )
+            logger.info("assuming role")
+            sts_client = _get_sts_client(self.source_key_id, self.source_key)
             assume_role_kwargs = {
                 "RoleArn": f"{self.role_arn}",
-                "RoleSessionName": f"{datetime.now().timestamp()}",
+                # only needs to be unique, nanoseconds keep roles assumed within the same second apart
+                "RoleSessionName": str(time.time_ns()),
                 "DurationSeconds": 43200,  # 12 hours
             }
             if hasattr(self, "external_id") and self.external_id:
@@ -338,7 +539,7 @@ class BaseModule:
             # max_duration = response['Role']['MaxSessionDuration']
             # response = sts_client.assume_role(
             #     RoleArn=f"{self.role_arn}",
-            #     RoleSessionName=f"{datetime.now().timestamp()}",
+            #     RoleSessionName=str(time.time_ns()),
             #     DurationSeconds=max_duration,  # 4 hours
             # )
 
@@ -4,14 +4,28 @@ check subprocess return codes.
 """
 import json
 import logging
+import mmap
 import os
-import re
-import shutil
 import subprocess
+import tempfile
 import time
 
+try:
+    # optional, iterates the cloudsploit result file record by record instead of loading it at once
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    # optional, decodes the cloudsploit result file much faster than the stdlib
+    import orjson
+except ImportError:
+    orjson = None
+
 from base_module import ModuleException, StatusCode
 
+logger = logging.getLogger(__name__)
+
 
 class CloudsploitSetUpMixin:
     """
@@ -19,13 +33,25 @@ class CloudsploitSetUpMixin:
     """
 
     _subprocess_error_message = "An error occurred when running Cloudsploit"
+    # env vars (e.g. credentials) set for the cloudsploit process only, instead of the process wide os.environ,
+    # so scans of different accounts can run side by side
+    _subprocess_env = None
+    _invalid_token_message = "The security token included in the request is invalid"
+    # --compliance=cis already covers the level 1 and level 2 benchmarks that cis1/cis2 select
     compliance_attrs = (
         "hipaa",
         "pci",
         "cis",
-        "cis1",
-        "cis2",
     )
+    _compliance_args = tuple(f"--compliance={each}" for each in compliance_attrs)
+
+    _config_file_arg = "--config=/home/ayush/accuknox/accuknox-pocs/configs/cloudsploit/config.js"
+    _provider_args = {
+        "cloudsploit_aws": ("--console=none",),
+        "cloudsploit_gcp": (_config_file_arg, "--console=none"),
+        "cloudsploit_azure": (_config_file_arg, "--console=none"),
+        "cloudsploit_oracle": (_config_file_arg, "--console=none"),
+    }
 
     def _check_subprocess(self, process):
         if not process.returncode == 0:
@@ -48,88 +74,107 @@ class CloudsploitSetUpMixin:
         output_file,
         module_name,
     ):
-        """Helper Method to construct CloudSploit Queries"""
-
-        # Construct common query string
-        query = f"./index.js --json={output_file} "
+        """Helper Method to construct CloudSploit Queries, returns the argv list of the command"""
 
-        if module_name == "cloudsploit_aws":
-            query += f"--console=none"
-
-        elif module_name == "cloudsploit_gcp":
-            query += "--config=/home/ayush/accuknox/accuknox-pocs/configs/cloudsploit/config.js --console=none"
-
-        elif module_name == "cloudsploit_azure":
-            query += "--config=/home/ayush/accuknox/accuknox-pocs/configs/cloudsploit/config.js --console=none"
-        
-        elif module_name == "cloudsploit_oracle":
-            query += "--config=/home/ayush/accuknox/accuknox-pocs/configs/cloudsploit/config.js --console=none"
+        # Construct common query arguments
+        query = ["./index.js", f"--json={output_file}", *self._provider_args.get(module_name, ())]
 
         if self.compliance is not None and self.compliance != "":
-            attrs = " ".join(f"--compliance={each}" for each in self.compliance_attrs)
-            query += f" {attrs}"
+            query += self._compliance_args
 
-        print(f"<debug>Successfully  constructed the CloudSploit query {query}</debug>")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("<debug>Successfully  constructed the CloudSploit query %s</debug>", " ".join(query))
         return query
 
     def execute_cloud_sploit_query(
         self,
-        output_file,
         filename,
     ):
-        """Executes the constructed CloudSploit query."""
+        """
+        Executes the constructed CloudSploit query. CloudSploit writes its results to a temp file of its own, which is
+        renamed to filename only once the results passed the checks, so a failed scan never leaves a file at filename.
+        """
+
+        # absolute, the query runs from the cs-accuknox folder
+        fd, temp_filename = tempfile.mkstemp(dir="/tmp", suffix=".json")
+        os.close(fd)
+        try:
+            self._run_cloud_sploit_query(temp_filename)
+            os.replace(temp_filename, filename)
+        except BaseException:
+            try:
+                os.remove(temp_filename)
+            except OSError:
+                pass
+            raise
 
-        print("Executing constructed CloudSploit query")
+        print(f"<success>Success! {filename} written to /tmp folder</success>")
+        return {
+            "response": f"Success! {filename} written to /tmp folder",
+            "status_code": StatusCode.SUCCESS.value,
+        }
+
+    def _run_cloud_sploit_query(self, filename):
+        """Runs the CloudSploit query into filename, raises when the results are empty or report an invalid token."""
+        logger.info("Executing constructed CloudSploit query")
         process = subprocess.run(
             self.construct_cloudsploit_query(
-                output_file,
+                filename,
                 self._module_name,
             ),
-            shell=True,
-            stdout=subprocess.PIPE,
+            # the results go to the --json file, only stderr is needed to report failures
+            stdout=subprocess.DEVNULL,
             stderr=subprocess.PIPE,
             cwd="cs-accuknox",
+            env={**os.environ, **self._subprocess_env} if self._subprocess_env else None,
         )
 
         self._check_subprocess(process)
 
-        if os.path.getsize(f"cs-accuknox/{output_file}") == 0:
-            print(f"<error>The size of the cs-accuknox/{output_file} is 0!</error>")
-            raise ModuleException(
-                f"{self._subprocess_error_message}, exc:{process.stderr}",
-                StatusCode.SUBPROCESS_ERROR,
-                subprocess_return_code=process.returncode,
-                subprocess_standard_output=process.stdout,
-                subprocess_standard_error=process.stderr,
-            )
-
-        if self.check_inbuilt_cloudsploit_error(file_location=f"cs-accuknox/{output_file}"):
-            print(f"<error>The security token included in the request is invalid!</error>")
-            raise ModuleException(
-                f"{self._subprocess_error_message}, exc:{process.stderr}",
-                StatusCode.SUBPROCESS_ERROR,
-                subprocess_return_code=process.returncode,
-                subprocess_standard_output=process.stdout,
-                subprocess_standard_error=process.stderr,
-            )
-
-        shutil.move(f"cs-accuknox/{output_file}", filename)
-        print(f"<success>Success! {filename} written to /tmp folder</success>")
-        return {
-            "response": f"Success! {filename} written to /tmp folder",
-            "status_code": StatusCode.SUCCESS.value,
-        }
+        # a single open + fstat serves both the size check and the token error check
+        with open(filename, "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                print(f"<error>The size of the {filename} is 0!</error>")
+                raise ModuleException(
+                    f"{self._subprocess_error_message}, exc:{process.stderr}",
+                    StatusCode.SUBPROCESS_ERROR,
+                    subprocess_return_code=process.returncode,
+                    subprocess_standard_output=process.stdout,
+                    subprocess_standard_error=process.stderr,
+                )
+
+            if self.check_inbuilt_cloudsploit_error(file):
+                print(f"<error>The security token included in the request is invalid!</error>")
+                raise ModuleException(
+                    f"{self._subprocess_error_message}, exc:{process.stderr}",
+                    StatusCode.SUBPROCESS_ERROR,
+                    subprocess_return_code=process.returncode,
+                    subprocess_standard_output=process.stdout,
+                    subprocess_standard_error=process.stderr,
+                )
 
-    @staticmethod
-    def check_inbuilt_cloudsploit_error(file_location):
-        with open(file_location, "r") as file:
+    @classmethod
+    def check_inbuilt_cloudsploit_error(cls, file):
+        """Checks the cloudsploit results, read from the given binary file object, for the invalid security token record."""
+        # the happy path never contains the message, a byte scan of the file rules it out without parsing any JSON
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if mapped.find(cls._invalid_token_message.encode()) == -1:
+                return False
+        file.seek(0)
+
+        if ijson is not None:
+            # lazily yields the records of the top level array, so memory stays flat and we stop at the first match
+            cloudsploit_data = ijson.items(file, "item")
+        elif orjson is not None:
+            cloudsploit_data = orjson.loads(file.read())
+        else:
             cloudsploit_data = json.load(file)
-            for data in cloudsploit_data:
-                resource = data.get("resource", "")
-                status = data.get("status", "")
-                message = data.get("message", "")
-
-                error_message = "The security token included in the request is invalid"
-                if resource == "N/A" and status == "UNKNOWN" and re.search(error_message, message):
-                    return True
+        for data in cloudsploit_data:
+            resource = data.get("resource", "")
+            status = data.get("status", "")
+            message = data.get("message", "")
+
+            # plain substring test, the message has no regex metacharacters
+            if resource == "N/A" and status == "UNKNOWN" and cls._invalid_token_message in message:
+                return True
         return False
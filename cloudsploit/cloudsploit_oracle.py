@@ -3,11 +3,12 @@
 This module runs an open source tool called Cloudsploit against an Oracle Cloud account and writes the result to a JSON file.
 """
 import os
-import time
 
 from base_module import BaseModule
 from cloudsploit_base import CloudsploitSetUpMixin
 
+_DEFAULT_OCI_REGION = "us-ashburn-1"
+
 
 def run(
     tenancy_ocid=None,
@@ -55,18 +56,17 @@ class CloudsploitOracle(BaseModule, CloudsploitSetUpMixin):
         compliance: Optional compliance types (e.g. cis, pci, hipaa)
         """
 
-        print("Setting Oracle Cloud env vars")
-        os.environ["OCI_TENANCY_OCID"] = self.tenancy_ocid
-        os.environ["OCI_USER_OCID"] = self.user_ocid
-        os.environ["OCI_FINGERPRINT"] = self.fingerprint
-        os.environ["OCI_PRIVATE_KEY"] = self.private_key
-        os.environ["OCI_REGION"] = self.region or "us-ashburn-1"
+        # passed to the cloudsploit process only, the env of this process is left untouched
+        self._subprocess_env = {
+            "OCI_TENANCY_OCID": self.tenancy_ocid,
+            "OCI_USER_OCID": self.user_ocid,
+            "OCI_FINGERPRINT": self.fingerprint,
+            "OCI_PRIVATE_KEY": self.private_key,
+            "OCI_REGION": self.region or _DEFAULT_OCI_REGION,
+        }
 
         filename = self.construct_filename("CS_ORACLE", "json")
-        return self.execute_cloud_sploit_query(
-            f"{time.time()}.json",
-            filename,
-        )
+        return self.execute_cloud_sploit_query(filename)
 
 
 if __name__ == "__main__":
@@ -5,13 +5,113 @@
 """
 from typing import Dict
 
+import functools
+import gzip
+import hashlib
 import json
+import logging
+import mmap
 import os
+import stat
 import subprocess
+import tempfile
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from json.decoder import JSONDecodeError
 
-from base_module import BaseModule, ModuleException, StatusCode
+try:
+    # optional, decodes the (often multi MB) steampipe output much faster than the stdlib
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    # optional, compresses gzip output on all cores
+    import mgzip
+except ImportError:
+    mgzip = None
+
+from base_module import BaseModule, ModuleException, StatusCode, _encode_json, _encode_json_member
+
+logger = logging.getLogger(__name__)
+
+
+def _ensure_private_dir(path):
+    """
+    Creates the directory if needed and returns whether only the current user can use it. A shared location like /tmp
+    may already hold a directory of that name created by another user, whose files must then neither be read nor written.
+    """
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        st = os.lstat(path)
+    except OSError as ex:
+        logger.warning("Could not create the directory %s: %s", path, ex)
+        return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and not st.st_mode & 0o077
+
+
+class _JsonObjectFileWriter:
+    """
+    Writes a JSON object into a file one member at a time, so the members do not have to be held in memory together. The file
+    is gzip compressed as it is written when compress is set, and removed again when the writing fails.
+    """
+
+    def __init__(self, filename, compress=False):
+        self.filename = filename
+        self.compress = compress
+        self.members_written = 0
+        self._file = None
+
+    def _open(self):
+        if not self.compress:
+            return open(self.filename, "wb")
+        if mgzip is not None:
+            return mgzip.open(self.filename, "wb", compresslevel=6, blocksize=1 << 20)
+        return gzip.open(self.filename, "wb", compresslevel=6)
+
+    def __enter__(self):
+        try:
+            self._file = self._open()
+        except OSError:
+            raise ModuleException("<error>Could not write results data to file.</error>", StatusCode.FILE_ERROR)
+        try:
+            self._file.write(b"{")
+        except BaseException as ex:
+            # __exit__ does not run when __enter__ raises, the file is closed and removed here
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            os.remove(self.filename)
+            if isinstance(ex, OSError):
+                raise ModuleException("<error>Could not write results data to file.</error>", StatusCode.FILE_ERROR)
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self._file.write(b"}")
+            self._file.close()
+        except OSError:
+            os.remove(self.filename)
+            raise ModuleException("<error>Could not write results data to file.</error>", StatusCode.FILE_ERROR)
+        if exc_type is not None:
+            os.remove(self.filename)
+
+    def write(self, key, value):
+        try:
+            member = _encode_json_member(key, value)
+        except Exception:
+            raise ModuleException("<error>Results data could not be JSON encoded.</error>", StatusCode.JSON_ENCODE_ERROR)
+        try:
+            if self.members_written:
+                self._file.write(b",")
+            self._file.write(member)
+        except OSError:
+            raise ModuleException("<error>Could not write results data to file.</error>", StatusCode.FILE_ERROR)
+        self.members_written += 1
 
 
 class AssetInventoryBase(BaseModule):
@@ -38,57 +138,408 @@ class AssetInventoryBase(BaseModule):
         "aws_iam_policy_attachment": {"columns": "*", "where": "is_attached"},
     }
 
+    # upper bound of concurrent steampipe queries issued by scan_tables and scan_table_regions
+    max_scan_workers = 8
+
+    # env var the steampipe plugin of the module reads its region from, set per query for the regions passed to call_get_data.
+    # Outside of the steampipe service the regions of scan_table_regions are then scanned one after another
+    region_env_var = None
+
+    # defaults for the env of the steampipe processes, a value set in the env of the module takes precedence. A parallel
+    # safe FDW lets postgres scan the foreign tables of one query (e.g. the branches of a union batch) in parallel
+    steampipe_env = {"STEAMPIPE_FDW_PARALLEL_SAFE": "1"}
+
+    # number of tables of a region scan_table_regions reads with one UNION ALL select, 0 or 1 queries every table on its own.
+    # A batch saves the per query overhead (a whole steampipe process outside of the service), but one failing table fails
+    # the batch, whose tables are then queried one by one. Batched tables list their column names only, without data types.
+    union_batch_size = 0
+
+    # On disk cache of query results, for re-runs that should not query every table again. It is enabled by a positive TTL
+    # in seconds in the result_cache_ttl_env_var env var and keyed by the module, its _get_result_cache_scope, the table, the
+    # region and the query. Metric tables change by the minute, their results are kept for at most metric_cache_ttl seconds.
+    result_cache_dir = None
+    result_cache_ttl_env_var = None
+    metric_cache_ttl = 300
+
+    # seconds to wait before the first retry of a table, doubled for every further retry
+    retry_base_delay = 2
+
+    # When enabled, the tables are queried over a pool of long lived connections to the postgres endpoint of `steampipe service`
+    # instead of spawning a `steampipe query` process (which boots its own database) for every table.
+    use_steampipe_service = False
+    steampipe_service_host = "localhost"
+    steampipe_service_port = 9193
+    steampipe_service_database = "steampipe"
+    steampipe_service_user = "steampipe"
+    # tables whose selected columns are expensive to hydrate and that are often empty, over the steampipe service they
+    # are first probed for a single row before running the full select
+    probe_empty_tables = frozenset({"aws_kms_key", "aws_iam_policy_attachment"})
+    # rows fetched per round trip from the server side cursor of a service query, so the whole result is never buffered
+    # by libpq in addition to the rows built from it
+    steampipe_service_itersize = 10000
+
     def __init__(self, kwargs: Dict):
         super().__init__(kwargs)
         self.max_first_consecutive_allowed_fails = 5
         self.current_consecutive_fails = 0
         self.first_consecutively_failed = True
+        # guards the consecutive fail counters above, call_get_data runs from scan_tables worker threads
+        self._fail_lock = threading.Lock()
+        self._pg = None
+        self._pg_type_names = {}
+        # table -> select query, the query of a table does not change during a scan
+        self._select_query_cache = {}
+        self._pg_lock = threading.Lock()
+        self._result_cache_ttl = self._get_result_cache_ttl()
+
+    def main(self) -> Dict:
+        try:
+            return super().main()
+        finally:
+            self._close_steampipe_service()
+
+    def _get_result_cache_ttl(self):
+        if not self.result_cache_dir or not self.result_cache_ttl_env_var:
+            return 0
+        ttl = os.environ.get(self.result_cache_ttl_env_var, "")
+        try:
+            ttl = float(ttl) if ttl else 0
+        except ValueError:
+            logger.warning("Ignoring invalid %s value %s, the result cache is disabled", self.result_cache_ttl_env_var, ttl)
+            return 0
+        if ttl > 0 and not _ensure_private_dir(self.result_cache_dir):
+            logger.warning("The result cache directory %s is not private to this user, the result cache is disabled",
+                           self.result_cache_dir)
+            return 0
+        return ttl
 
-    def _get_selection_params(self, table):
+    def _get_result_cache_scope(self):
+        """Returns the values besides table, region and query that identify a cached result, e.g. the account."""
+        return ()
+
+    def _get_result_cache_path(self, table, region):
+        """Returns the cache file of the result of the table in the region, None when the cache is disabled."""
+        if self._result_cache_ttl <= 0:
+            return None
+        if region is None and self.region_env_var:
+            region = os.environ.get(self.region_env_var, "")
+        parts = (self._module_name, *self._get_result_cache_scope(), table, region or "", self._get_select_query(table))
+        key = hashlib.blake2b("\0".join(map(str, parts)).encode(), digest_size=20).hexdigest()
+        return os.path.join(self.result_cache_dir, f"{key}.json.gz")
+
+    def _read_cached_result(self, table, region):
+        """Returns the cached result of the table in the region, None when there is none or it expired."""
+        path = self._get_result_cache_path(table, region)
+        if path is None:
+            return None
+        ttl = min(self._result_cache_ttl, self.metric_cache_ttl) if "_metric_" in table else self._result_cache_ttl
+        try:
+            if time.time() - os.stat(path).st_mtime >= ttl:
+                return None
+            with gzip.open(path, "rb") as f:
+                raw = f.read()
+            return orjson.loads(raw) if orjson is not None else json.loads(raw)
+        except (OSError, EOFError, ValueError):
+            # ValueError covers the JSONDecodeError of both json and orjson, a broken entry is queried again
+            return None
+
+    def _write_cached_result(self, table, region, data):
+        path = self._get_result_cache_path(table, region)
+        if path is None:
+            return
+        # written next to the entry and renamed over it, so concurrent readers never see a partial file
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}"
+        try:
+            # encoded like the output file, so a result read from the cache is written out the same as a fresh one
+            raw = _encode_json(data)
+            with gzip.open(temp_path, "wb", compresslevel=1) as f:
+                f.write(raw)
+            os.replace(temp_path, path)
+        except (OSError, TypeError, ValueError) as ex:
+            # the cache is only an optimization, it never fails the table
+            logger.warning("Could not cache the result of table %s: %s", table, ex)
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+    def _get_steampipe_service_password(self):
+        """
+        Returns the password of the steampipe service database. It is either provided through the STEAMPIPE_DATABASE_PASSWORD
+        env var (which steampipe also honours when starting the service) or read from the file steampipe generated it into.
+        """
+        password = os.environ.get("STEAMPIPE_DATABASE_PASSWORD")
+        if password:
+            return password
+
+        install_dir = os.environ.get("STEAMPIPE_INSTALL_DIR", os.path.expanduser("~/.steampipe"))
+        try:
+            with open(os.path.join(install_dir, "internal", ".passwd"), "r") as f:
+                return f.read().strip()
+        except OSError:
+            raise ModuleException(
+                "<error>Could not read the steampipe service password, set STEAMPIPE_DATABASE_PASSWORD</error>",
+                StatusCode.FILE_ERROR,
+            )
+
+    def _start_steampipe_service(self):
+        """Starts `steampipe service` once, so all the queries of the scan share its database."""
+        logger.info("<info>Starting steampipe service</info>")
+        process = subprocess.run(
+            ["steampipe", "service", "start", "--database-port", str(self.steampipe_service_port)],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=self._get_steampipe_env(),
+        )
+        if process.returncode != 0:
+            raise ModuleException(
+                f"<error>Failed to start steampipe service, exc: {process.stderr}</error>",
+                StatusCode.SUBPROCESS_ERROR,
+                subprocess_return_code=process.returncode,
+                subprocess_standard_output=process.stdout,
+                subprocess_standard_error=process.stderr,
+            )
+
+    def _get_steampipe_pool(self):
+        """
+        Returns the connection pool of the steampipe service, starting the service and connecting on first use. A psycopg2
+        connection runs one query at a time, so every worker thread of the scan borrows its own connection per query.
+        """
+        with self._pg_lock:
+            if self._pg is not None:
+                return self._pg
+
+            try:
+                import psycopg2
+                import psycopg2.extras
+                import psycopg2.pool
+            except ImportError:
+                raise ModuleException(
+                    "psycopg2 is required to query the steampipe service but is not installed",
+                    StatusCode.PACKAGE_NOT_FOUND,
+                )
+
+            if orjson is not None:
+                # the json(b) columns (tags, configs, ...) are decoded by psycopg2 with the stdlib by default
+                psycopg2.extras.register_default_json(globally=True, loads=orjson.loads)
+                psycopg2.extras.register_default_jsonb(globally=True, loads=orjson.loads)
+
+            self._start_steampipe_service()
+            try:
+                # connections are opened as the workers need them, at most one per worker is ever borrowed
+                pool = psycopg2.pool.ThreadedConnectionPool(
+                    1,
+                    max(1, self.max_scan_workers),
+                    host=self.steampipe_service_host,
+                    port=self.steampipe_service_port,
+                    dbname=self.steampipe_service_database,
+                    user=self.steampipe_service_user,
+                    password=self._get_steampipe_service_password(),
+                )
+                connection = self._borrow_steampipe_connection(pool)
+                try:
+                    with connection.cursor() as cursor:
+                        cursor.execute("select oid, typname from pg_type")
+                        self._pg_type_names = dict(cursor.fetchall())
+                finally:
+                    pool.putconn(connection)
+            except psycopg2.Error as ex:
+                raise ModuleException(
+                    f"<error>Could not connect to the steampipe service, exc: {ex}</error>",
+                    StatusCode.THIRD_PARTY_API_ERROR,
+                    subprocess_standard_error=str(ex),
+                )
+
+            self._pg = pool
+            return self._pg
+
+    @staticmethod
+    def _borrow_steampipe_connection(pool):
+        connection = pool.getconn()
+        # every table is an independent query, a failing one must not abort the others
+        connection.autocommit = True
+        return connection
+
+    def _close_steampipe_service(self):
+        if self._pg is not None:
+            self._pg.closeall()
+            self._pg = None
+
+    def _query_steampipe_service(self, table, steampipe_select_query, region_info):
+        """
+        Runs the select query over a steampipe service connection and returns the result in the same
+        {"columns": [...], "rows": [...]} format as `steampipe query --output json`.
+        """
+        from psycopg2 import Error as PostgresError
+        from psycopg2.extras import RealDictCursor
+
+        pool = self._get_steampipe_pool()
+        try:
+            connection = self._borrow_steampipe_connection(pool)
+        except PostgresError as ex:
+            raise ModuleException(
+                f"<error>Could not connect to the steampipe service, exc: {ex}</error>",
+                StatusCode.THIRD_PARTY_API_ERROR,
+                subprocess_standard_error=str(ex),
+            )
+        try:
+            if table in self.probe_empty_tables:
+                # a one row probe is a cheap round trip on the open connection and skips the costly columns when there is no row
+                with connection.cursor() as cursor:
+                    cursor.execute(f"select 1 from ({steampipe_select_query}) as probe limit 1")
+                    if cursor.fetchone() is None:
+                        return {"columns": [], "rows": []}
+
+            # a named (server side) cursor only lives in a transaction, the connection is borrowed by this thread alone
+            connection.autocommit = False
+            try:
+                with connection.cursor("steampipe_select", cursor_factory=RealDictCursor) as cursor:
+                    cursor.itersize = self.steampipe_service_itersize
+                    cursor.execute(steampipe_select_query)
+                    rows = [dict(row) for row in cursor]
+                    columns = [
+                        {"name": column.name, "data_type": self._pg_type_names.get(column.type_code, str(column.type_code))}
+                        for column in cursor.description
+                    ]
+            finally:
+                if not connection.closed:
+                    # nothing is written, ending the transaction of the cursor is all that is left to do
+                    connection.rollback()
+        except PostgresError as ex:
+            raise ModuleException(
+                f"<error>Failed to run query on table: {table}, {region_info}, exc: {ex}</error>",
+                StatusCode.THIRD_PARTY_API_ERROR,
+                subprocess_standard_error=str(ex),
+            )
+        finally:
+            # a connection the failed query broke is dropped instead of being handed out again
+            pool.putconn(connection, close=bool(connection.closed))
+
+        return {"columns": columns, "rows": rows}
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def _get_selection_params(cls, table):
         """
         This function returns the selection string from the dictionary for the two tables that are special cases. For all other tables it returns
-        an asterisk by default, which means to select all fields from the table.
+        an asterisk by default, which means to select all fields from the table. The result only depends on the class and the table, so it is
+        looked up once per process.
         """
-        if table in self.selection_string_dict:
-            params = self.selection_string_dict[table]
+        if table in cls.selection_string_dict:
+            params = cls.selection_string_dict[table]
             columns = params["columns"]
             where = params.get("where", "")
 
             return columns, where
         return "*", ""
 
-    def construct_steampipe_select_query(self, table):
+    def construct_steampipe_select_query(self, table, connection=None):
         COLUMNS, WHERE = self._get_selection_params(table)
-        query = f"select {COLUMNS} from {table}"
+        query = f"select {COLUMNS} from {self._get_table_source(table, connection)}"
         if WHERE:
             query = f"{query} where {WHERE}"
 
         return query
 
-    def _get_data(self, table):
+    @staticmethod
+    def _get_table_source(table, connection=None):
+        """Returns the table qualified with the steampipe connection (schema) it is read from, if any"""
+        if connection:
+            return f"{connection}.{table}"
+        return table
+
+    def _get_region_connection(self, region):
+        """
+        Returns the name of the steampipe connection serving the region, which the steampipe service queries of the region are
+        qualified with. Modules without a connection per region return None.
+        """
+        return None
+
+    def _get_select_query(self, table, connection=None):
+        """Returns the select query of the table, built once per table and connection and reused by the retries of a scan."""
+        key = (table, connection)
+        query = self._select_query_cache.get(key)
+        if query is None:
+            query = self._select_query_cache[key] = self.construct_steampipe_select_query(table, connection)
+        return query
+
+    def _get_data(self, table, region=None):
         """
         This function gets the Steampipe data for a specific table and can be used in all Steampipe modules. It takes in the name of the table
-        as a parameter.
+        as a parameter. When a region is given, the steampipe process gets it through region_env_var instead of the region of the environment,
+        and the steampipe service query reads the table from the connection of the region.
+        """
+        logger.debug("<info>querying table %s</info>", table)
+        return self._run_select(table, self._get_select_query(table, self._get_query_connection(region)), region)
+
+    def _get_query_connection(self, region):
         """
-        print(f"<info>querying table {table}</info>")
+        Returns the steampipe connection the queries of the region read from. Only the service needs one, the steampipe query
+        processes get the region through their env.
+        """
+        if self.use_steampipe_service and region is not None:
+            return self._get_region_connection(region)
+        return None
+
+    def _run_select(self, table, steampipe_select_query, region=None):
+        """Runs the select query over the steampipe service or a steampipe query process and returns the decoded output."""
         region_info = ""
         if self._module_name == "aws_asset_inventory":
-            region_info = f"aws_region: {os.environ.get('AWS_DEFAULT_REGION', 'no region specified for aws')}"
+            region_info = f"aws_region: {region or os.environ.get('AWS_DEFAULT_REGION', 'no region specified for aws')}"
         elif self._module_name == "oci_asset_inventory":
-            region_info = f"oci_region: {os.environ.get('OCI_REGION', getattr(self, 'region', 'no region specified for oci'))}"
+            region_info = f"oci_region: {region or os.environ.get('OCI_REGION', getattr(self, 'region', 'no region specified for oci'))}"
 
-        steampipe_select_query = self.construct_steampipe_select_query(table)
-        query = f'''steampipe query "{steampipe_select_query}" --output json'''
-        # query = f'''su steampipeuser -m -c "steampipe query \\"{steampipe_select_query}\\" --output json"'''
+        if self.use_steampipe_service:
+            current_time = time.time()
+            data = self._query_steampipe_service(table, steampipe_select_query, region_info)
+            logger.debug("It took %s seconds to fetch data for %s", time.time() - current_time, table)
+            return data
+
+        # passed as argv without a shell, so the query needs no quoting and saves spawning /bin/sh per table
+        query = ["steampipe", "query", steampipe_select_query, "--output", "json"]
         current_time = time.time()
-        process = subprocess.run(
-            query,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        print(f"It took {time.time() - current_time} seconds to fetch data for {table}")
+        # stdout goes to a temporary file rather than a pipe, so the (possibly multi MB) output is parsed from the file
+        # instead of first being buffered into one bytes object
+        with tempfile.TemporaryFile() as stdout_file:
+            process = subprocess.run(
+                query,
+                stdout=stdout_file,
+                stderr=subprocess.PIPE,
+                env=self._get_steampipe_env(region),
+            )
+            logger.debug("It took %s seconds to fetch data for %s", time.time() - current_time, table)
 
+            if process.returncode != 0 or os.fstat(stdout_file.fileno()).st_size == 0:
+                # the output is only read back to report the failure
+                stdout_file.seek(0)
+                process.stdout = stdout_file.read()
+                self._raise_steampipe_process_error(process, table, region_info)
+
+            try:
+                return self._load_steampipe_output(stdout_file)
+            except (JSONDecodeError, UnicodeDecodeError):
+                # not logging process.stdout since it can contain sensitive information
+                raise ModuleException(
+                    f"<error>An unexpected error occurred. The data was in an unexpected format, table: {table}, {region_info}, exc:{process.stderr}</error>",
+                    StatusCode.SUBPROCESS_ERROR,
+                    subprocess_return_code=process.returncode,
+                    subprocess_standard_output=process.stdout,
+                    subprocess_standard_error=process.stderr,
+                )
+
+    def _get_steampipe_env(self, region=None):
+        """
+        Returns the env of a steampipe process. The region goes into the env of the process only, os.environ is shared by
+        the concurrently running queries.
+        """
+        env = {**self.steampipe_env, **os.environ}
+        if region is not None and self.region_env_var:
+            env[self.region_env_var] = region
+        return env
+
+    @staticmethod
+    def _raise_steampipe_process_error(process, table, region_info):
+        """Raises the ModuleException matching a failed or empty `steampipe query` run."""
         if process.returncode != 0:
             raise ModuleException(
                 f"<error>Failed to run query on table: {table}, {region_info},  exc: {process.stderr} stdout: {process.stdout}</error>",
@@ -105,60 +556,211 @@ class AssetInventoryBase(BaseModule):
                 subprocess_standard_output=process.stdout,
                 subprocess_standard_error=process.stderr,
             )
-        if not process.stdout:
-            raise ModuleException(
-                f"<error>Failed to  run query on table: {table}, {region_info}, exc: {process.stderr} stdout:{process.stdout}</error>",
-                StatusCode.SUBPROCESS_ERROR,
-                subprocess_return_code=process.returncode,
-                subprocess_standard_output=process.stdout,
-                subprocess_standard_error=process.stderr,
-            )
-        try:
-            return json.loads(process.stdout.decode("utf-8", "ignore"))
-        except JSONDecodeError:
-            # not logging process.stdout since it can contain sensitive information
-            raise ModuleException(
-                f"<error>An unexpected error occurred. The data was in an unexpected format, table: {table}, {region_info}, exc:{process.stderr}</error>",
-                StatusCode.SUBPROCESS_ERROR,
-                subprocess_return_code=process.returncode,
-                subprocess_standard_output=process.stdout,
-                subprocess_standard_error=process.stderr,
-            )
+        raise ModuleException(
+            f"<error>Failed to  run query on table: {table}, {region_info}, exc: {process.stderr} stdout:{process.stdout}</error>",
+            StatusCode.SUBPROCESS_ERROR,
+            subprocess_return_code=process.returncode,
+            subprocess_standard_output=process.stdout,
+            subprocess_standard_error=process.stderr,
+        )
+
+    @staticmethod
+    def _load_steampipe_output(stdout_file):
+        """Decodes the JSON steampipe wrote to stdout_file, which must not be empty."""
+        if orjson is not None:
+            # orjson parses the memory mapped file as it is, without copying it into a bytes object first
+            with mmap.mmap(stdout_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                return orjson.loads(view)
+        stdout_file.seek(0)
+        # json.loads detects the encoding of bytes itself, decoding them to a str first would be an extra pass over the output
+        return json.loads(stdout_file.read())
 
-    def call_get_data(self, table, retry_count=1):
+    def call_get_data(self, table, retry_count=1, region=None):
         """
         calls get_data and if fails then retries with  retry_count times for given table for the failed query for
         authentication/authorization errors only else raise exception
         """
+        for attempt in range(retry_count + 1):
+            try:
+                data = self._get_data(table, region)
+            except ModuleException as ex:
+                exception_identifier = self.has_authentication_error(ex)
+                if attempt < retry_count and exception_identifier:
+                    logger.info("<info>retrying for table %s %s times</info>", table, retry_count - attempt)
+                    time.sleep(self.retry_base_delay * 2**attempt)
+                    continue
+                self._report_failed_table(table, ex, exception_identifier, region)
+                return None
+
+            with self._fail_lock:
+                self.first_consecutively_failed = False
+            self._write_cached_result(table, region, data)
+            return data
+
+    def _get_batch_data(self, tables, region=None):
+        """
+        Reads the tables of a region with one UNION ALL select, every row tagged with its table and turned into jsonb so the
+        differently shaped tables fit in one result. Returns a dict of table name to data, empty tables included.
+        """
+        connection = self._get_query_connection(region)
+        steampipe_select_query = " union all ".join(
+            f"select '{table}' as __src, to_jsonb(t) as __row from ({self._get_select_query(table, connection)}) as t"
+            for table in tables
+        )
+        output = self._run_select(", ".join(tables), steampipe_select_query, region)
+
+        data = {table: {"columns": [], "rows": []} for table in tables}
+        for row in output["rows"]:
+            data[row["__src"]]["rows"].append(row["__row"])
+        for table_data in data.values():
+            if table_data["rows"]:
+                table_data["columns"] = [{"name": name} for name in table_data["rows"][0]]
+        return data
+
+    def call_get_batch(self, tables, region=None):
+        """
+        calls get_batch_data for the tables of a region and returns None when the batch fails, so the caller queries its tables
+        one by one. A failed batch is not reported, the failures of the single tables are.
+        """
         try:
-            data = self._get_data(table)
+            data = self._get_batch_data(tables, region)
+        except ModuleException as ex:
+            logger.info("<info>batch query of tables %s failed, querying them one by one: %s</info>", ", ".join(tables), ex)
+            return None
+
+        with self._fail_lock:
             self.first_consecutively_failed = False
+        for table, table_data in data.items():
+            self._write_cached_result(table, region, table_data)
+        return data
+
+    def _batch_tasks(self, tasks):
+        """Groups the (table, region) pairs into (tables, region) batches of at most union_batch_size tables of one region."""
+        if self.union_batch_size <= 1:
+            return [((table,), region) for table, region in tasks]
+
+        tables_by_region = {}
+        for table, region in tasks:
+            tables_by_region.setdefault(region, []).append(table)
+        return [
+            (tuple(tables[i : i + self.union_batch_size]), region)
+            for region, tables in tables_by_region.items()
+            for i in range(0, len(tables), self.union_batch_size)
+        ]
+
+    def _report_failed_table(self, table, ex, exception_identifier, region=None):
+        """
+        Reports a table that could not be queried and raises the error when the first
+        max_first_consecutive_allowed_fails tables of the scan all failed
+        """
+        with self._fail_lock:
+            self.current_consecutive_fails += 1
+            should_raise = (
+                self.first_consecutively_failed is True
+                and self.current_consecutive_fails >= self.max_first_consecutive_allowed_fails
+            )
+        if exception_identifier:
+            # to email details error to the internal team
+            print(f"<INTERNAL-TEAM-ISSUE>{ex}</INTERNAL-TEAM-ISSUE>")
+            # mail short description of error to the clients
+            print(
+                f"<CUSTOMER-ISSUE>Steampipe failed to query table: {table} due to authorization/authentication issue {exception_identifier}</CUSTOMER-ISSUE>",
+            )
+        else:
+            # send detailed error message to the internal team
+            print(f"<INTERNAL-TEAM-ISSUE>{ex}</INTERNAL-TEAM-ISSUE>")
+        if should_raise:
+            raise ex
+
+    def scan_tables(self, tables) -> Dict:
+        """
+        Queries the given tables concurrently and returns a dict of table name to data for every table that returned data.
+        The queries are I/O bound (steampipe subprocess + cloud API calls), so a thread pool cuts the wall clock time of a scan
+        from the sum of the table latencies to roughly the slowest one.
+        """
+        data = self.scan_table_regions([(table, None) for table in tables])
+
+        # keep the order of the requested tables in the output
+        return {table: data[(table, None)] for table in tables if (table, None) in data}
+
+    def scan_table_regions(self, tasks, on_result=None) -> Dict:
+        """
+        Queries the given (table, region) pairs concurrently on one thread pool and returns a dict of (table, region) to data
+        for every pair that returned data. A region of None queries the table in the region of the environment. With
+        union_batch_size the tables of a region are read in batches, the tables of a failed batch are queued one by one.
+        When on_result is given, it is called with every pair and its data (None if the query failed) as soon as the pair
+        completes, and the data is left to it instead of being collected in the returned dict. Modules passing the region
+        through region_env_var scan one region at a time, unless they query the steampipe service.
+        """
+        data = {}
+        if on_result is None:
+
+            def on_result(task, output):
+                if output:
+                    data[task] = output
+
+        if self._result_cache_ttl > 0:
+            cached_tasks = set()
+            for task in tasks:
+                cached = self._read_cached_result(*task)
+                if cached is not None:
+                    cached_tasks.add(task)
+                    on_result(task, cached)
+            if cached_tasks:
+                # a cached result is a table that worked, it must not leave the scan counting the first failures
+                with self._fail_lock:
+                    self.first_consecutively_failed = False
+                logger.info("<info>Using the cached results of %s of %s queries</info>", len(cached_tasks), len(tasks))
+                tasks = [task for task in tasks if task not in cached_tasks]
+        if not tasks:
             return data
-        except ModuleException as ex:
-            exception_identifier = self.has_authentication_error(ex)
-            if retry_count > 0 and exception_identifier:
-                print(f"<info>retrying for table {table} {retry_count} times</info>")
-                time.sleep(5)
-                return self.call_get_data(table, retry_count - 1)
-            else:
-                self.current_consecutive_fails += 1
-                if exception_identifier:
-                    # to email details error to the internal team
-                    print(f"<INTERNAL-TEAM-ISSUE>{ex}</INTERNAL-TEAM-ISSUE>")
-                    # mail short description of error to the clients
-                    print(
-                        f"<CUSTOMER-ISSUE>Steampipe failed to query table: {table} due to authorization/authentication issue {exception_identifier}</CUSTOMER-ISSUE>",
-                    )
-                    if (
-                        self.first_consecutively_failed is True
-                        and self.current_consecutive_fails >= self.max_first_consecutive_allowed_fails
-                    ):
-                        raise ex
+
+        # every query of the scan is built here once, the workers then only look their query up in the cache
+        for table, region in tasks:
+            self._get_select_query(table, self._get_query_connection(region))
+
+        if self.use_steampipe_service or not self.region_env_var:
+            self._scan_batches(self._batch_tasks(tasks), on_result)
+            return data
+
+        # Concurrent `steampipe query` processes share the database and plugin the first one started, which keep the
+        # region_env_var of that process, so the regions are scanned one after another, each with its tables concurrently
+        tasks_by_region = {}
+        for task in tasks:
+            tasks_by_region.setdefault(task[1], []).append(task)
+        for region_tasks in tasks_by_region.values():
+            self._scan_batches(self._batch_tasks(region_tasks), on_result)
+        return data
+
+    def _scan_batches(self, batches, on_result):
+        """Queries the (tables, region) batches of scan_table_regions on one thread pool, passing every pair to on_result."""
+        with ThreadPoolExecutor(max_workers=min(self.max_scan_workers, len(batches))) as executor:
+            futures = {}
+            for tables, region in batches:
+                if len(tables) == 1:
+                    futures[executor.submit(self.call_get_data, tables[0], region=region)] = (tables, region)
                 else:
-                    # send detailed error message to the internal team
-                    print(f"<INTERNAL-TEAM-ISSUE>{ex}</INTERNAL-TEAM-ISSUE>")
-                    if (
-                        self.first_consecutively_failed is True
-                        and self.current_consecutive_fails >= self.max_first_consecutive_allowed_fails
-                    ):
-                        raise ex
+                    futures[executor.submit(self.call_get_batch, tables, region)] = (tables, region)
+            try:
+                # the single table queries of failed batches are added while waiting, which as_completed does not allow
+                pending = set(futures)
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        tables, region = futures.pop(future)
+                        output = future.result()
+                        if len(tables) == 1:
+                            on_result((tables[0], region), output)
+                        elif output is None:
+                            for table in tables:
+                                retry = executor.submit(self.call_get_data, table, region=region)
+                                futures[retry] = ((table,), region)
+                                pending.add(retry)
+                        else:
+                            for table, table_data in output.items():
+                                on_result((table, region), table_data)
+            except BaseException:
+                # the scan is aborted, do not wait for the queued queries before raising
+                for future in futures:
+                    future.cancel()
+                raise
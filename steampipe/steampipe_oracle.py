@@ -3,9 +3,293 @@
     The OCI Asset Inventory module collects metadata on Oracle Cloud resources using Steampipe
     and writes the results to a JSON file.
 """
+import json
+import logging
 import os
-from base_module import StatusCode
-from asset_inventory_base import AssetInventoryBase
+from base_module import ModuleException, StatusCode, _compile_substring_alternation
+from asset_inventory_base import AssetInventoryBase, _JsonObjectFileWriter, _ensure_private_dir
+
+logger = logging.getLogger(__name__)
+
+
+# tenant-level tables (no compartment_id column), typically identity/global services that exist at the tenancy level
+_TENANT_LEVEL_TABLES = frozenset({
+    # Identity and access management tables (tenant-level)
+    "oci_identity_user",
+    "oci_identity_group", 
+    "oci_identity_api_key",
+    "oci_identity_auth_token",
+    "oci_identity_authentication_policy",
+    "oci_identity_customer_secret_key",
+    "oci_identity_db_credential",
+    "oci_identity_dynamic_group",
+    "oci_identity_network_source",
+    "oci_region",  # Regions are global
+    
+    # Certificate version tables (these have different structure)
+    "oci_certificates_management_certificate_authority_version",
+    "oci_certificates_management_certificate_version",
+    
+    # Volume backup policies (these are tenant-level)
+    "oci_core_volume_default_backup_policy",
+    
+    # Some MySQL cluster tables  
+    "oci_mysql_heat_wave_cluster",
+    
+    # Object storage objects (these use different identifiers)
+    "oci_objectstorage_object",
+    
+    # Tables with schema issues (no compartment_id column)
+    "oci_bastion_session",
+    "oci_certificates_authority_bundle",
+})
+
+
+_FIELDS = (
+    "tenancy",
+    "user",
+    "fingerprint",
+    "key_file",
+    "regions",  # Changed to regions
+    "label",
+    # compartment_id is optional, so we don't include it here
+)
+
+_GLOBAL_TABLES = (
+    # Identity and Access Management
+    "oci_identity_tenancy",
+    "oci_identity_user",
+    "oci_identity_group",
+    "oci_identity_policy",
+    "oci_identity_compartment",
+    "oci_identity_api_key",
+    "oci_identity_auth_token",
+    "oci_identity_authentication_policy",
+    "oci_identity_availability_domain",
+    "oci_identity_customer_secret_key",
+    "oci_identity_db_credential",
+    "oci_identity_domain",
+    "oci_identity_dynamic_group",
+    "oci_identity_network_source",
+    "oci_identity_tag_default",
+    "oci_identity_tag_namespace",
+    # Regional information
+    "oci_region",
+)
+
+_REGIONAL_TABLES = (
+    # Application Development & Management
+    "oci_adm_knowledge_base",
+    "oci_adm_vulnerability_audit",
+    
+    # AI & Analytics - Note: May have DNS issues in some environments
+    # "oci_ai_anomaly_detection_ai_private_endpoint",
+    # "oci_ai_anomaly_detection_data_asset",
+    # "oci_ai_anomaly_detection_model",
+    # "oci_ai_anomaly_detection_project",
+    "oci_analytics_instance",
+    
+    # API Gateway
+    "oci_apigateway_api",
+    
+    # Application Migration
+    "oci_application_migration_migration",
+    "oci_application_migration_source",
+    
+    # Container Registry & Artifacts
+    "oci_artifacts_container_image",
+    "oci_artifacts_container_image_signature",
+    "oci_artifacts_container_repository",
+    "oci_artifacts_generic_artifact",
+    "oci_artifacts_repository",
+    
+    # Auto Scaling
+    "oci_autoscaling_auto_scaling_configuration",
+    "oci_autoscaling_auto_scaling_policy",
+    
+    # Bastion
+    "oci_bastion_bastion",
+    # "oci_bastion_session",  # Schema issue - no compartment_id column
+    
+    # Big Data Service
+    "oci_bds_bds_instance",
+    
+    # Budget
+    "oci_budget_alert_rule",
+    "oci_budget_budget",
+    
+    # Certificates
+    # "oci_certificates_authority_bundle",  # Schema issue - no compartment_id column
+    "oci_certificates_management_association",
+    "oci_certificates_management_ca_bundle",
+    "oci_certificates_management_certificate",
+    "oci_certificates_management_certificate_authority",
+    "oci_certificates_management_certificate_authority_version",
+    "oci_certificates_management_certificate_version",
+    
+    # Cloud Guard
+    "oci_cloud_guard_configuration",
+    "oci_cloud_guard_detector_recipe",
+    "oci_cloud_guard_managed_list",
+    "oci_cloud_guard_responder_recipe",
+    "oci_cloud_guard_target",
+    
+    # Container Instances
+    "oci_container_instances_container",
+    "oci_container_instances_container_instance",
+    
+    # Container Engine (OKE)
+    "oci_containerengine_cluster",
+    
+    # Core Compute & Networking
+    "oci_core_instance",
+    "oci_core_instance_configuration",
+    "oci_core_instance_metric_cpu_utilization",
+    "oci_core_instance_metric_cpu_utilization_daily",
+    "oci_core_instance_metric_cpu_utilization_hourly",
+    "oci_core_image",
+    "oci_core_image_custom",
+    "oci_core_cluster_network",
+    "oci_core_vcn",
+    "oci_core_subnet",
+    "oci_core_internet_gateway",
+    "oci_core_nat_gateway",
+    "oci_core_service_gateway",
+    "oci_core_local_peering_gateway",
+    "oci_core_drg",
+    "oci_core_route_table",
+    "oci_core_security_list",
+    "oci_core_network_security_group",
+    "oci_core_dhcp_options",
+    "oci_core_public_ip",
+    "oci_core_public_ip_pool",
+    "oci_core_vnic_attachment",
+    
+    # Block & Boot Volumes
+    "oci_core_volume",
+    "oci_core_volume_attachment",
+    "oci_core_volume_backup",
+    "oci_core_volume_backup_policy",
+    "oci_core_volume_default_backup_policy",
+    "oci_core_volume_group",
+    "oci_core_block_volume_replica",
+    "oci_core_boot_volume",
+    "oci_core_boot_volume_attachment",
+    "oci_core_boot_volume_backup",
+    "oci_core_boot_volume_replica",
+    "oci_core_boot_volume_metric_read_ops",
+    "oci_core_boot_volume_metric_read_ops_daily",
+    "oci_core_boot_volume_metric_read_ops_hourly",
+    "oci_core_boot_volume_metric_write_ops",
+    "oci_core_boot_volume_metric_write_ops_daily",
+    "oci_core_boot_volume_metric_write_ops_hourly",
+    
+    # Load Balancers
+    "oci_core_load_balancer",
+    "oci_core_network_load_balancer",
+    
+    # Database Services
+    "oci_database_db_system",
+    "oci_database_db_home",
+    "oci_database_db",
+    "oci_database_autonomous_database",
+    "oci_database_autonomous_db_metric_cpu_utilization",
+    "oci_database_autonomous_db_metric_cpu_utilization_daily",
+    "oci_database_autonomous_db_metric_cpu_utilization_hourly",
+    "oci_database_autonomous_db_metric_storage_utilization",
+    "oci_database_autonomous_db_metric_storage_utilization_daily",
+    "oci_database_autonomous_db_metric_storage_utilization_hourly",
+    "oci_database_cloud_vm_cluster",
+    "oci_database_exadata_infrastructure",
+    "oci_database_pluggable_database",
+    "oci_database_software_image",
+    
+    # DevOps
+    "oci_devops_project",
+    "oci_devops_repository",
+    
+    # DNS
+    "oci_dns_rrset",
+    "oci_dns_tsig_key",
+    "oci_dns_zone",
+    
+    # Events
+    "oci_events_rule",
+    
+    # File Storage
+    "oci_file_storage_file_system",
+    "oci_file_storage_mount_target",
+    "oci_file_storage_snapshot",
+    
+    # Functions
+    "oci_functions_application",
+    "oci_functions_function",
+    
+    # Key Management
+    "oci_kms_key",
+    # "oci_kms_key_version",  # Requires specific qualifiers
+    "oci_kms_vault",
+    
+    # Logging
+    "oci_logging_log",
+    "oci_logging_log_group",
+    "oci_logging_search",
+    
+    # MySQL Database Service
+    "oci_mysql_backup",
+    "oci_mysql_channel",
+    "oci_mysql_configuration",
+    "oci_mysql_configuration_custom",
+    # "oci_mysql_db_system",  # Runtime error - index out of range
+    "oci_mysql_db_system_metric_connections",
+    "oci_mysql_db_system_metric_connections_daily",
+    "oci_mysql_db_system_metric_connections_hourly",
+    "oci_mysql_db_system_metric_cpu_utilization",
+    "oci_mysql_db_system_metric_cpu_utilization_daily",
+    "oci_mysql_db_system_metric_cpu_utilization_hourly",
+    "oci_mysql_db_system_metric_memory_utilization",
+    "oci_mysql_db_system_metric_memory_utilization_daily",
+    "oci_mysql_heat_wave_cluster",
+    
+    # Network Firewall
+    "oci_network_firewall_firewall",
+    "oci_network_firewall_policy",
+    
+    # NoSQL Database
+    "oci_nosql_table",
+    "oci_nosql_table_metric_read_throttle_count",
+    "oci_nosql_table_metric_read_throttle_count_daily",
+    "oci_nosql_table_metric_read_throttle_count_hourly",
+    "oci_nosql_table_metric_storage_utilization",
+    "oci_nosql_table_metric_storage_utilization_daily",
+    "oci_nosql_table_metric_storage_utilization_hourly",
+    "oci_nosql_table_metric_write_throttle_count",
+    "oci_nosql_table_metric_write_throttle_count_daily",
+    "oci_nosql_table_metric_write_throttle_count_hourly",
+    
+    # Object Storage
+    "oci_objectstorage_bucket",
+    "oci_objectstorage_object",
+    
+    # Notifications
+    "oci_ons_notification_topic",
+    "oci_ons_subscription",
+    
+    # Queue
+    "oci_queue_queue",
+    
+    # Resource Search (Requires specific qualifiers)
+    # "oci_resource_search",
+    
+    # Resource Manager
+    "oci_resourcemanager_stack",
+    
+    # Streaming
+    "oci_streaming_stream",
+    
+    # Vault
+    "oci_vault_secret",
+)
 
 
 def run(
@@ -16,6 +300,10 @@ def run(
     regions=None,  # Changed from region to regions to support multiple
     label=None,
     compartment_id=None,  # NEW
+    use_steampipe_service=False,
+    union_batch_size=0,
+    include_sub_compartments=True,
+    compress_output=False,
 ):
     kwargs = dict(
         tenancy=tenancy,
@@ -25,6 +313,10 @@ def run(
         regions=regions,  # Changed to regions
         label=label,
         compartment_id=compartment_id,  # NEW
+        use_steampipe_service=use_steampipe_service,
+        union_batch_size=union_batch_size,
+        include_sub_compartments=include_sub_compartments,
+        compress_output=compress_output,
     )
     return OCIAsset(kwargs).main()
 
@@ -40,11 +332,21 @@ class OCIAsset(AssetInventoryBase):
                                                # It must be a comma separated list
         label: 'TEST'
         compartment_id: 'ocid1.compartment.oc1..xxxxx'
+        use_steampipe_service: False  # query through `steampipe service` instead of a `steampipe query` process per table
+        union_batch_size: 0  # read up to this many tables of a region with one UNION ALL query, 0 queries them one by one
+        include_sub_compartments: True  # with compartment_id, also collect the resources of all its sub-compartments
+        compress_output: False  # write the results gzip compressed, to a .json.gz file
     """
 
     _module_name = "oci_asset_inventory"
+    # the (table, region) queries share one pool, they mostly wait on the OCI APIs
+    max_scan_workers = 32
+    region_env_var = "OCI_REGION"
+    result_cache_dir = "/tmp/oci_cache"
+    result_cache_ttl_env_var = "OCI_CACHE_TTL"
+    # deduplicated keeping the order, so the identifier matched first is the same in every run
     _access_exception_list = list(
-        set(
+        dict.fromkeys(
             AssetInventoryBase._access_exception_list + [
                 "NotAuthorizedOrNotFound",
                 "AuthorizationFailed", 
@@ -66,348 +368,291 @@ class OCIAsset(AssetInventoryBase):
         )
     )
 
-    _fields = [
-        "tenancy",
-        "user",
-        "fingerprint",
-        "key_file",
-        "regions",  # Changed to regions
-        "label",
-        # compartment_id is optional, so we don't include it here
-    ]
-
-    global_table_list = [
-        # Identity and Access Management
-        "oci_identity_tenancy",
-        "oci_identity_user",
-        "oci_identity_group",
-        "oci_identity_policy",
-        "oci_identity_compartment",
-        "oci_identity_api_key",
-        "oci_identity_auth_token",
-        "oci_identity_authentication_policy",
-        "oci_identity_availability_domain",
-        "oci_identity_customer_secret_key",
-        "oci_identity_db_credential",
-        "oci_identity_domain",
-        "oci_identity_dynamic_group",
-        "oci_identity_network_source",
-        "oci_identity_tag_default",
-        "oci_identity_tag_namespace",
-        # Regional information
-        "oci_region",
-    ]
-
-    regional_table_list = [
-        # Application Development & Management
-        "oci_adm_knowledge_base",
-        "oci_adm_vulnerability_audit",
-        
-        # AI & Analytics - Note: May have DNS issues in some environments
-        # "oci_ai_anomaly_detection_ai_private_endpoint",
-        # "oci_ai_anomaly_detection_data_asset",
-        # "oci_ai_anomaly_detection_model",
-        # "oci_ai_anomaly_detection_project",
-        "oci_analytics_instance",
-        
-        # API Gateway
-        "oci_apigateway_api",
-        
-        # Application Migration
-        "oci_application_migration_migration",
-        "oci_application_migration_source",
-        
-        # Container Registry & Artifacts
-        "oci_artifacts_container_image",
-        "oci_artifacts_container_image_signature",
-        "oci_artifacts_container_repository",
-        "oci_artifacts_generic_artifact",
-        "oci_artifacts_repository",
-        
-        # Auto Scaling
-        "oci_autoscaling_auto_scaling_configuration",
-        "oci_autoscaling_auto_scaling_policy",
-        
-        # Bastion
-        "oci_bastion_bastion",
-        # "oci_bastion_session",  # Schema issue - no compartment_id column
-        
-        # Big Data Service
-        "oci_bds_bds_instance",
-        
-        # Budget
-        "oci_budget_alert_rule",
-        "oci_budget_budget",
-        
-        # Certificates
-        # "oci_certificates_authority_bundle",  # Schema issue - no compartment_id column
-        "oci_certificates_management_association",
-        "oci_certificates_management_ca_bundle",
-        "oci_certificates_management_certificate",
-        "oci_certificates_management_certificate_authority",
-        "oci_certificates_management_certificate_authority_version",
-        "oci_certificates_management_certificate_version",
-        
-        # Cloud Guard
-        "oci_cloud_guard_configuration",
-        "oci_cloud_guard_detector_recipe",
-        "oci_cloud_guard_managed_list",
-        "oci_cloud_guard_responder_recipe",
-        "oci_cloud_guard_target",
-        
-        # Container Instances
-        "oci_container_instances_container",
-        "oci_container_instances_container_instance",
-        
-        # Container Engine (OKE)
-        "oci_containerengine_cluster",
-        
-        # Core Compute & Networking
-        "oci_core_instance",
-        "oci_core_instance_configuration",
-        "oci_core_instance_metric_cpu_utilization",
-        "oci_core_instance_metric_cpu_utilization_daily",
-        "oci_core_instance_metric_cpu_utilization_hourly",
-        "oci_core_image",
-        "oci_core_image_custom",
-        "oci_core_cluster_network",
-        "oci_core_vcn",
-        "oci_core_subnet",
-        "oci_core_internet_gateway",
-        "oci_core_nat_gateway",
-        "oci_core_service_gateway",
-        "oci_core_local_peering_gateway",
-        "oci_core_drg",
-        "oci_core_route_table",
-        "oci_core_security_list",
-        "oci_core_network_security_group",
-        "oci_core_dhcp_options",
-        "oci_core_public_ip",
-        "oci_core_public_ip_pool",
-        "oci_core_vnic_attachment",
-        
-        # Block & Boot Volumes
-        "oci_core_volume",
-        "oci_core_volume_attachment",
-        "oci_core_volume_backup",
-        "oci_core_volume_backup_policy",
-        "oci_core_volume_default_backup_policy",
-        "oci_core_volume_group",
-        "oci_core_block_volume_replica",
-        "oci_core_boot_volume",
-        "oci_core_boot_volume_attachment",
-        "oci_core_boot_volume_backup",
-        "oci_core_boot_volume_replica",
-        "oci_core_boot_volume_metric_read_ops",
-        "oci_core_boot_volume_metric_read_ops_daily",
-        "oci_core_boot_volume_metric_read_ops_hourly",
-        "oci_core_boot_volume_metric_write_ops",
-        "oci_core_boot_volume_metric_write_ops_daily",
-        "oci_core_boot_volume_metric_write_ops_hourly",
-        
-        # Load Balancers
-        "oci_core_load_balancer",
-        "oci_core_network_load_balancer",
-        
-        # Database Services
-        "oci_database_db_system",
-        "oci_database_db_home",
-        "oci_database_db",
-        "oci_database_autonomous_database",
-        "oci_database_autonomous_db_metric_cpu_utilization",
-        "oci_database_autonomous_db_metric_cpu_utilization_daily",
-        "oci_database_autonomous_db_metric_cpu_utilization_hourly",
-        "oci_database_autonomous_db_metric_storage_utilization",
-        "oci_database_autonomous_db_metric_storage_utilization_daily",
-        "oci_database_autonomous_db_metric_storage_utilization_hourly",
-        "oci_database_cloud_vm_cluster",
-        "oci_database_exadata_infrastructure",
-        "oci_database_pluggable_database",
-        "oci_database_software_image",
-        
-        # DevOps
-        "oci_devops_project",
-        "oci_devops_repository",
-        
-        # DNS
-        "oci_dns_rrset",
-        "oci_dns_tsig_key",
-        "oci_dns_zone",
-        
-        # Events
-        "oci_events_rule",
-        
-        # File Storage
-        "oci_file_storage_file_system",
-        "oci_file_storage_mount_target",
-        "oci_file_storage_snapshot",
-        
-        # Functions
-        "oci_functions_application",
-        "oci_functions_function",
-        
-        # Key Management
-        "oci_kms_key",
-        # "oci_kms_key_version",  # Requires specific qualifiers
-        "oci_kms_vault",
-        
-        # Logging
-        "oci_logging_log",
-        "oci_logging_log_group",
-        "oci_logging_search",
-        
-        # MySQL Database Service
-        "oci_mysql_backup",
-        "oci_mysql_channel",
-        "oci_mysql_configuration",
-        "oci_mysql_configuration_custom",
-        # "oci_mysql_db_system",  # Runtime error - index out of range
-        "oci_mysql_db_system_metric_connections",
-        "oci_mysql_db_system_metric_connections_daily",
-        "oci_mysql_db_system_metric_connections_hourly",
-        "oci_mysql_db_system_metric_cpu_utilization",
-        "oci_mysql_db_system_metric_cpu_utilization_daily",
-        "oci_mysql_db_system_metric_cpu_utilization_hourly",
-        "oci_mysql_db_system_metric_memory_utilization",
-        "oci_mysql_db_system_metric_memory_utilization_daily",
-        "oci_mysql_heat_wave_cluster",
-        
-        # Network Firewall
-        "oci_network_firewall_firewall",
-        "oci_network_firewall_policy",
-        
-        # NoSQL Database
-        "oci_nosql_table",
-        "oci_nosql_table_metric_read_throttle_count",
-        "oci_nosql_table_metric_read_throttle_count_daily",
-        "oci_nosql_table_metric_read_throttle_count_hourly",
-        "oci_nosql_table_metric_storage_utilization",
-        "oci_nosql_table_metric_storage_utilization_daily",
-        "oci_nosql_table_metric_storage_utilization_hourly",
-        "oci_nosql_table_metric_write_throttle_count",
-        "oci_nosql_table_metric_write_throttle_count_daily",
-        "oci_nosql_table_metric_write_throttle_count_hourly",
-        
-        # Object Storage
-        "oci_objectstorage_bucket",
-        "oci_objectstorage_object",
-        
-        # Notifications
-        "oci_ons_notification_topic",
-        "oci_ons_subscription",
-        
-        # Queue
-        "oci_queue_queue",
-        
-        # Resource Search (Requires specific qualifiers)
-        # "oci_resource_search",
-        
-        # Resource Manager
-        "oci_resourcemanager_stack",
-        
-        # Streaming
-        "oci_streaming_stream",
-        
-        # Vault
-        "oci_vault_secret",
-    ]
+    # Errors of a table that the tenancy does not support (tier, subscription, schema), unlike authorization or network
+    # errors they do not go away on the next run. The tables failing with them are remembered per tenancy and compartment
+    # (some are caused by the compartment filter) in unsupported_tables_file, kept in the private result_cache_dir, and
+    # not queried again, unless OCI_FORCE_REPROBE=1 is set. SQLSTATE HV000 is not one of them, the FDW reports every
+    # plugin error with it, throttling and timeouts included.
+    _unsupported_subscription_identifiers = frozenset({
+        "FREE_TIER_NOT_SUPPORTED",
+        "Cloudguard subscription is not available",
+        "subscription is not available",
+    })
+    _unsupported_table_identifiers = _unsupported_subscription_identifiers | {
+        "missing 2 required quals",
+        "missing 3 required quals",
+        "column \"compartment_id\" does not exist",
+        "SQLSTATE 42703",
+    }
+    # searched on its own, the error of an unsupported table often also holds an access identifier that comes first
+    _unsupported_table_re = _compile_substring_alternation(_unsupported_table_identifiers)
+    # errors that go away on a later run, a table failing with them is never remembered as unsupported
+    _transient_table_error_re = _compile_substring_alternation((
+        "TooManyRequests",
+        "Http Status Code: 429",
+        "Http Status Code: 500",
+        "Http Status Code: 502",
+        "Http Status Code: 503",
+        "Http Status Code: 504",
+        "InternalServerError",
+        "ServiceUnavailable",
+        "RequestTimeout",
+        "i/o timeout",
+        "context deadline exceeded",
+        "connection reset by peer",
+        "no such host",
+    ))
+    # access identifiers of a missing policy or credential, OCI also answers a missing subscription with
+    # NotAuthorizedOrNotFound, which only the message of the error then tells apart
+    _authorization_identifiers = frozenset({
+        "NotAuthorizedOrNotFound",
+        "AuthorizationFailed",
+        "Forbidden",
+        "NotAuthenticated",
+        *AssetInventoryBase._access_exception_list,
+    })
+    unsupported_tables_file = "unsupported_tables.json"
+
+    _fields = _FIELDS
+
+    global_table_list = _GLOBAL_TABLES
+    regional_table_list = _REGIONAL_TABLES
+    # for the membership checks of the scan, built once
+    _global_tables = frozenset(global_table_list)
+
+    include_sub_compartments = True
+    compress_output = False
+    # compartment_id and, with include_sub_compartments, all the compartments below it, and the where clause selecting
+    # them, built once for all the tables. Set by run
+    _compartment_ids = ()
+    _compartment_filter = ""
 
-    def construct_steampipe_select_query(self, table):
+    def construct_steampipe_select_query(self, table, connection=None):
         columns, base_where = self._get_selection_params(table)
 
-        query = f"select {columns} from {table}"
+        query = f"select {columns} from {self._get_table_source(table, connection)}"
 
         filters = []
         if base_where:
             filters.append(base_where)
             
         # Only apply compartment_id filter to regional tables, not global/identity tables
-        if (getattr(self, "compartment_id", None) and 
-            table not in self.global_table_list and
+        if (self._compartment_filter and
+            table not in self._global_tables and
             not self._is_tenant_level_table(table)):
-            filters.append(f"compartment_id = '{self.compartment_id}'")
+            filters.append(self._compartment_filter)
 
         if filters:
             query += " where " + " and ".join(filters)
 
         return query
     
+    def _set_compartments(self, compartment_ids):
+        self._compartment_ids = compartment_ids
+        if len(compartment_ids) == 1:
+            self._compartment_filter = f"compartment_id = '{compartment_ids[0]}'"
+        else:
+            # pushed down to the plugin as one qual for the whole subtree
+            quoted_ids = ", ".join(f"'{compartment_id}'" for compartment_id in compartment_ids)
+            self._compartment_filter = f"compartment_id in ({quoted_ids})"
+
+    def _get_compartment_ids(self):
+        """
+        Returns compartment_id followed by the ids of all the active compartments below it, found with a breadth first walk
+        over one read of oci_identity_compartment. Falls back to compartment_id alone when the compartments can not be read.
+        """
+        try:
+            output = self._run_select(
+                "oci_identity_compartment",
+                "select id, compartment_id from oci_identity_compartment where lifecycle_state = 'ACTIVE'",
+            )
+        except ModuleException as ex:
+            print(f"<INTERNAL-TEAM-ISSUE>Could not expand the sub-compartments of {self.compartment_id}: {ex}</INTERNAL-TEAM-ISSUE>")
+            return (self.compartment_id,)
+
+        children = {}
+        for row in output["rows"]:
+            children.setdefault(row["compartment_id"], []).append(row["id"])
+
+        compartment_ids = [self.compartment_id]
+        seen = {self.compartment_id}
+        for compartment_id in compartment_ids:
+            for child in children.get(compartment_id, ()):
+                if child not in seen:
+                    seen.add(child)
+                    compartment_ids.append(child)
+        return tuple(compartment_ids)
+
+    def __init__(self, kwargs):
+        super().__init__(kwargs)
+        # parsed once, before any query. No regions leaves an empty tuple that _check_fields reports
+        self.regions = self._parse_regions(getattr(self, "regions", None))
+        # (table, region) pairs that failed with one of _unsupported_table_identifiers in this scan
+        self._unsupported_tables = set()
+
+    @staticmethod
+    def _parse_regions(regions):
+        """Returns the regions of the comma separated string (or list) as a tuple, without blanks and duplicates."""
+        if not regions:
+            return ()
+        if isinstance(regions, str):
+            regions = regions.split(",")
+        return tuple(dict.fromkeys(region.strip() for region in regions if region.strip()))
+
+    def _is_unsupported_table_error(self, ex, exception_identifier):
+        """Returns whether the error of the table will come back on every run, so the table is not queried again."""
+        error = ex.subprocess_standard_error or ""
+        if isinstance(error, bytes):
+            error = error.decode("utf-8", "ignore")
+        match = self._unsupported_table_re.search(error)
+        if match is None or self._transient_table_error_re.search(error):
+            return False
+        if exception_identifier in self._authorization_identifiers:
+            return match.group() in self._unsupported_subscription_identifiers
+        return True
+
+    def _report_failed_table(self, table, ex, exception_identifier, region=None):
+        if self._is_unsupported_table_error(ex, exception_identifier):
+            # set.add is atomic, the tables fail on the scan worker threads
+            self._unsupported_tables.add((table, region))
+        super()._report_failed_table(table, ex, exception_identifier, region)
+
+    def _get_unsupported_tables_path(self):
+        """Returns the path of unsupported_tables_file, None when result_cache_dir is not private to this user."""
+        if not _ensure_private_dir(self.result_cache_dir):
+            logger.warning("%s is not private to this user, unsupported tables are not remembered", self.result_cache_dir)
+            return None
+        return os.path.join(self.result_cache_dir, self.unsupported_tables_file)
+
+    def _get_unsupported_tables_key(self):
+        """Returns the key of the tables of this scan in unsupported_tables_file, the tenancy and the compartment."""
+        return "/".join(map(str, self._get_result_cache_scope()))
+
+    def _load_unsupported_tables(self, path):
+        """Returns the file content, {tenancy/compartment: {table: [region, ...]}} with None for the global tables."""
+        if path is None:
+            return {}
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as ex:
+            logger.warning("Ignoring the unreadable %s: %s", path, ex)
+            return {}
+
+    def _save_unsupported_tables(self, path, known_tables, force_reprobe):
+        if path is None or (not self._unsupported_tables and not force_reprobe):
+            return
+        key = self._get_unsupported_tables_key()
+        scope_tables = {} if force_reprobe else known_tables.get(key, {})
+        for table, region in self._unsupported_tables:
+            regions = scope_tables.setdefault(table, [])
+            if region not in regions:
+                regions.append(region)
+        known_tables[key] = scope_tables
+
+        temp_filename = f"{path}.{os.getpid()}"
+        try:
+            with open(temp_filename, "w") as f:
+                json.dump(known_tables, f)
+            os.replace(temp_filename, path)
+        except OSError as ex:
+            logger.warning("Could not save the unsupported tables to %s: %s", path, ex)
+
+    def _get_result_cache_scope(self):
+        return self.tenancy, getattr(self, "compartment_id", None) or ""
+
+    def _get_region_connection(self, region):
+        # steampipe connection names can not contain dashes, the region us-ashburn-1 is served by the connection oci_us_ashburn_1
+        return "oci_" + region.replace("-", "_")
+
     def _is_tenant_level_table(self, table):
         """
         Check if a table is tenant-level (doesn't have compartment_id column)
         These are typically identity/global services that exist at the tenancy level
         """
-        tenant_level_tables = {
-            # Identity and access management tables (tenant-level)
-            "oci_identity_user",
-            "oci_identity_group", 
-            "oci_identity_api_key",
-            "oci_identity_auth_token",
-            "oci_identity_authentication_policy",
-            "oci_identity_customer_secret_key",
-            "oci_identity_db_credential",
-            "oci_identity_dynamic_group",
-            "oci_identity_network_source",
-            "oci_region",  # Regions are global
-            
-            # Certificate version tables (these have different structure)
-            "oci_certificates_management_certificate_authority_version",
-            "oci_certificates_management_certificate_version",
-            
-            # Volume backup policies (these are tenant-level)
-            "oci_core_volume_default_backup_policy",
-            
-            # Some MySQL cluster tables  
-            "oci_mysql_heat_wave_cluster",
-            
-            # Object storage objects (these use different identifiers)
-            "oci_objectstorage_object",
-            
-            # Tables with schema issues (no compartment_id column)
-            "oci_bastion_session",
-            "oci_certificates_authority_bundle",
-        }
-        return table in tenant_level_tables
+        return table in _TENANT_LEVEL_TABLES
 
-    def run(self):
-        data = {}
+    def _scan_to_file(self, tasks, filename):
+        """
+        Scans the (table, region) pairs and writes every table into the JSON object of the file as soon as all its regions
+        completed, so only the tables still waiting for a region or for an earlier table are held in memory. The tables are
+        written in the order of the table lists, the regional ones as a dict of region to data. Returns the number of tables
+        written.
+        """
+        tables = [*self.global_table_list, *self.regional_table_list]
+        # results every table still waits for, one per region for the regional tables
+        remaining = dict.fromkeys(tables, 0)
+        for table, _ in tasks:
+            remaining[table] += 1
+        results = {}
+        next_table = 0
 
-        # Support multiple regions 
-        if not self.regions:
-            raise ValueError("OCI regions are required")
+        with _JsonObjectFileWriter(filename, compress=self.compress_output) as writer:
 
-        # Parse regions string and create list 
-        self.regions = self.regions.replace(" ", "")
-        self.regions = self.regions.split(",")
-        
-        # Fetch global tables
-        for table in self.global_table_list:
-            print(f"<info>About to fetch: {table}</info>")
-            output = self.call_get_data(table)
-            if output:
-                data.update({table: output})
-
-        # Fetch regional tables (iterate through all regions like AWS)
-        for table in self.regional_table_list:
-            data_dict = {}
-            for region in self.regions:
-                os.environ["OCI_REGION"] = region
-                print(f"<info>Fetching regional data: {table} in region {region}</info>")
-                
-                output = self.call_get_data(table)
+            def write_result(task, output):
+                nonlocal next_table
+                table, region = task
+                remaining[table] -= 1
                 if output:
-                    data_dict.update({region: output})
-            
-            if data_dict:
-                data.update({table: data_dict})
+                    if region is None:
+                        results[table] = output
+                    else:
+                        results.setdefault(table, {})[region] = output
+
+                while next_table < len(tables) and remaining[tables[next_table]] == 0:
+                    table = tables[next_table]
+                    next_table += 1
+                    output = results.pop(table, None)
+                    if output and table not in self._global_tables:
+                        # the regions complete in any order
+                        output = {region: output[region] for region in self.regions if region in output}
+                    if output:
+                        writer.write(table, output)
+
+            self.scan_table_regions(tasks, write_result)
+        return writer.members_written
+
+    def run(self):
+        if getattr(self, "compartment_id", None):
+            if self.include_sub_compartments:
+                self._set_compartments(self._get_compartment_ids())
+                logger.info("<info>Collecting the resources of %s compartment(s)</info>", len(self._compartment_ids))
+            else:
+                self._set_compartments((self.compartment_id,))
+        
+        # Fetch global tables and the regional tables of every region (like AWS) on one pool. Over the steampipe service the
+        # queries of different regions run concurrently, each reading the connection of its region, steampipe query
+        # processes get the region through OCI_REGION and scan the regions one after another
+        logger.info("<info>About to fetch %s global tables</info>", len(self.global_table_list))
+        tasks = [(table, None) for table in self.global_table_list]
+        for region in self.regions:
+            logger.info("<info>Fetching regional data for %s tables in region %s</info>", len(self.regional_table_list), region)
+            tasks.extend((table, region) for table in self.regional_table_list)
+
+        force_reprobe = os.environ.get("OCI_FORCE_REPROBE") == "1"
+        unsupported_tables_path = self._get_unsupported_tables_path()
+        known_tables = self._load_unsupported_tables(unsupported_tables_path)
+        if not force_reprobe:
+            unsupported = known_tables.get(self._get_unsupported_tables_key(), {})
+            scanned_tasks = len(tasks)
+            tasks = [(table, region) for table, region in tasks if region not in unsupported.get(table, ())]
+            if len(tasks) < scanned_tasks:
+                logger.info(
+                    "<info>Skipping %s table queries the tenancy does not support, set OCI_FORCE_REPROBE=1 to query them again</info>",
+                    scanned_tasks - len(tasks),
+                )
+
+        # the tables are streamed into the file while the scan runs
+        filename = self.construct_filename("OCI", "json.gz" if self.compress_output else "json")
+        total_tables_with_data = self._scan_to_file(tasks, filename)
+        self._save_unsupported_tables(unsupported_tables_path, known_tables, force_reprobe)
 
         # Generate summary statistics
         total_tables_attempted = len(self.global_table_list) + len(self.regional_table_list)
-        total_tables_with_data = len(data)
-        
-        filename = self.construct_filename("OCI", "json")
-        if data:
-            self._write_to_file(filename, data, decode=False, jsonify=True)
+
+        if total_tables_with_data:
             print(f"<success> Success! {filename} written to /tmp folder</success>")
             print(f"<success> Data collected from {total_tables_with_data} tables across {len(self.global_table_list)} global and {len(self.regional_table_list)} regional tables in {len(self.regions)} region(s): {', '.join(self.regions)}</success>")
             return {
@@ -417,6 +662,7 @@ class OCIAsset(AssetInventoryBase):
                 "tables_with_data": total_tables_with_data,
             }
 
+        os.remove(filename)
         return {
             "response": "Scan completed but no data available to write to disk",
             "status_code": StatusCode.SUCCESS.value,